@@ -1,8 +1,27 @@
-import maya.cmds as cmds
-import maya.mel as mm
-from math import sqrt
+try:
+    import maya.cmds as cmds
+    import maya.mel as mm
+    import maya.utils
+    ExecuteDeferred = maya.utils.executeDeferred
+except ImportError:
+    # outside maya the calls are replayed from a SceneReplay capture
+    cmds = mm = None
+    def ExecuteDeferred(func, *args):
+        func(*args)
+from math import sqrt, floor, acos, isnan, isinf
 from struct import *
+from array import array
+from cStringIO import StringIO
+import cPickle
+import copy
+import hashlib
+import os
 import re
+import shutil
+import sys
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
 
 #-----------------------------------------------
 # Util Script
@@ -12,9 +31,6 @@ def GetAssinedMaterialNodeFromModel(model):
     cmds.hyperShade(smn=True)
     return cmds.ls(sl=True)
 
-def GetUVCoordinate(uv):
-    return cmds.getAttr(uv)[0]
-
 def GetVertexNormal(vtx):
     cmds.select(vtx)
     count = len(cmds.polyNormalPerVertex(q=True, x=True))
@@ -31,129 +47,475 @@ def GetVertexNormal(vtx):
         avg[cnt] *= dif
     return avg
 
-def GetVertexPosition(vtx):
-    return cmds.pointPosition(vtx)
+# direction of a row vector through a maya 4x4 matrix, without the translation
+def TransformDirection(m, v):
+    return [v[0]*m[0] + v[1]*m[4] + v[2]*m[8], v[0]*m[1] + v[1]*m[5] + v[2]*m[9], v[0]*m[2] + v[1]*m[6] + v[2]*m[10]]
+
+def IsFiniteNumber(x):
+    try:
+        return not (isnan(x) or isinf(x))
+    except TypeError:
+        return False
 
-def GetIndex(name):
-    m = re.search('\[\w+\]', name)
-    index = m.group().lstrip('[').rstrip(']')
-    return int(index)
+def IsFiniteVector(v, size):
+    try:
+        if len(v) != size: return False
+    except TypeError:
+        return False
+    for x in v:
+        if not IsFiniteNumber(x): return False
+    return True
+
+# world positions of every vertex of the model in one query
+def GetVertexPositions(model):
+    count = cmds.polyEvaluate(model, v=True)
+    if count <= 0: return []
+    flat = cmds.xform(ComponentRangeName(model, 'vtx', count), q=True, ws=True, t=True)
+    pos = []
+    for i in range(0, len(flat), 3):
+        pos += [tuple(flat[i:i+3])]
+    return pos
 
-def GetIndices(name):
-    r = re.compile('\d+')
-    vtx_list = r.findall(name)[1:]
-    for i in range(len(vtx_list)):
-        vtx_list[i] = int(vtx_list[i])
-    return vtx_list
+COMPONENT_RANGE = re.compile('\[(\d+)(?::(\d+))?\]$')
 
-def GetVertexIndicesFromTriangle(f):
-    cmds.select(f)
-    vtxs = cmds.polyInfo(fv=True)
+def ComponentName(model, attr_name, index):
+    return '%s.%s[%d]' % (model, attr_name, index)
+
+def ComponentRangeName(model, attr_name, count):
+    return '%s.%s[0:%d]' % (model, attr_name, count - 1)
+
+# 'model.map[3:17]' -> [3, 4, ..., 17], 'model.map[3]' -> [3]
+def ExpandComponentRange(name):
+    m = COMPONENT_RANGE.search(name)
+    start = int(m.group(1))
+    if m.group(2) == None:
+        return [start]
+    return range(start, int(m.group(2)) + 1)
+
+# flatten the compressed names returned by maya into one index list
+def GetComponentIndices(names):
     indices = []
-    for vtx in vtxs:
-        indices += GetIndices(vtx)
+    if names == None: return indices
+    for name in names:
+        indices += ExpandComponentRange(name)
     return indices
 
-def GetVerticesList(model):
-    count = cmds.polyEvaluate(model, v=True)
-    return GetPolyElementNameList(model, count, 'vtx')
+def GetHierarchyNames(root):
+    cmds.select(root)
+    cmds.select(hierarchy=True)
+    return cmds.ls(sl=True, l=True), cmds.ls(sl=True)
 
-def GetFacesList(model):
-    count = cmds.polyEvaluate(model, f=True)
-    return GetPolyElementNameList(model, count, 'f')
-    
-def GetUVList(model):
-    count = cmds.polyEvaluate(model, uv=True)
-    return GetPolyElementNameList(model, count, 'uv')
+# world positions of all joints with one query
+def GetJointPositions(names):
+    if len(names) <= 0: return []
+    flat = cmds.xform(names, q=True, ws=True, t=True)
+    pos = []
+    for i in range(0, len(flat), 3):
+        pos += [flat[i:i+3]]
+    return pos
+
+# [[weight index, target name], ...] of the blendShape node
+def GetBlendShapeTargets(blend_shape):
+    indices = cmds.getAttr(blend_shape + '.weight', mi=True)
+    if indices == None: return []
+    alias = cmds.aliasAttr(blend_shape, q=True)
+    if alias == None: alias = []
+    names = {}
+    for i in range(0, len(alias), 2):
+        names[alias[i+1]] = alias[i]
+    targets = []
+    for index in indices:
+        targets += [[index, names.get('weight[%d]' % index, 'weight%d' % index)]]
+    return targets
+
+# sparse deltas stored in the full weight (6000) item of the target
+def GetBlendShapeTargetItem(blend_shape, index):
+    return '%s.inputTarget[0].inputTargetGroup[%d].inputTargetItem[6000]' % (blend_shape, index)
+
+def GetVertexIndexList(model):
+    return range(cmds.polyEvaluate(model, v=True))
+
+def GetFaceIndexList(model):
+    return range(cmds.polyEvaluate(model, f=True))
+
+def GetUVIndexList(model):
+    return range(cmds.polyEvaluate(model, uv=True))
+
+#------------------------------------------------
+# Scene Query Cache
+#------------------------------------------------
+class SceneQueryCache:
+    def __init__(self):
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    # the results are shared, do not modify them.
+    def Query(self, func, *args, **kwargs):
+        key = repr((func.__name__, args, sorted(kwargs.items())))
+        try:
+            result = self.results[key]
+            self.hits += 1
+        except KeyError:
+            result = func(*args, **kwargs)
+            self.results[key] = result
+            self.misses += 1
+        return result
+
+    def GetAttr(self, attr):
+        return self.Query(cmds.getAttr, attr)
+
+    def PolyEvaluate(self, model, **kwargs):
+        return self.Query(cmds.polyEvaluate, model, **kwargs)
+
+    def VertexPositions(self, model):
+        return self.Query(GetVertexPositions, model)
+
+    def VertexIndices(self, model):
+        return self.Query(GetVertexIndexList, model)
+
+    def FaceIndices(self, model):
+        return self.Query(GetFaceIndexList, model)
+
+    def UVIndices(self, model):
+        return self.Query(GetUVIndexList, model)
+
+    def AssignedMaterials(self, model):
+        return self.Query(GetAssinedMaterialNodeFromModel, model)
+
+    def Clear(self):
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def Report(self):
+        print '-------------------'
+        print 'query cache hits: ', self.hits
+        print 'query cache misses: ', self.misses
+
+#------------------------------------------------
+# Section Cache
+#------------------------------------------------
+SECTION_CACHE_VERSION = 5
+
+def HashValues(*values):
+    return hashlib.md5(repr(values)).hexdigest()
+
+# stores extracted structures and written bytes between exports,
+# each entry is only reused while its key (hash of the inputs) matches.
+class SectionCache:
+    def __init__(self, path):
+        self.path = path
+        self.entries = self.Read()
+
+    def Read(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            f = open(self.path, 'rb')
+            try:
+                version, entries = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception, inst:
+            print 'ignore broken section cache: ', inst
+            return {}
+        if version != SECTION_CACHE_VERSION:
+            return {}
+        return entries
+
+    def Load(self, name, key):
+        try:
+            stored_key, data = self.entries[name]
+        except KeyError:
+            return None
+        if stored_key != key:
+            return None
+        return cPickle.loads(data)
+
+    def Store(self, name, key, data):
+        self.entries[name] = (key, cPickle.dumps(data, 2))
+
+    def LoadBytes(self, name, key):
+        try:
+            stored_key, data = self.entries['bytes:' + name]
+        except KeyError:
+            return None
+        if stored_key != key:
+            return None
+        return data
+
+    def StoreBytes(self, name, key, data):
+        self.entries['bytes:' + name] = (key, data)
+
+    def Save(self):
+        f = open(self.path, 'wb')
+        try:
+            cPickle.dump((SECTION_CACHE_VERSION, self.entries), f, 2)
+        finally:
+            f.close()
+
+def GetMeshKey(cache, model):
+    face_count = cache.PolyEvaluate(model, f=True)
+    uv_count = cache.PolyEvaluate(model, uv=True)
+    vtx_count = cache.PolyEvaluate(model, v=True)
+    topology = None
+    normals = None
+    uvs = None
+    if face_count > 0:
+        topology = cache.Query(cmds.polyInfo, ComponentRangeName(model, 'f', face_count), fv=True)
+    if vtx_count > 0:
+        normals = cache.Query(cmds.polyNormalPerVertex, ComponentRangeName(model, 'vtx', vtx_count), q=True, xyz=True)
+    if uv_count > 0:
+        uvs = cache.GetAttr(ComponentRangeName(model, 'uv', uv_count))
+    return HashValues(cache.VertexPositions(model), topology, normals, uvs, GetShadingAssignment(cache, model))
+
+# members of every shading group connected to the model
+def GetShadingAssignment(cache, model):
+    shapes = cache.Query(cmds.listRelatives, model, s=True, f=True)
+    if shapes == None: return []
+    groups = cache.Query(cmds.listConnections, shapes, type='shadingEngine')
+    if groups == None: return []
+    assigned = []
+    for sg in sorted(set(groups)):
+        assigned += [[sg, cache.Query(cmds.sets, sg, q=True)]]
+    return assigned
+
+def GetMaterialKey(cache, model):
+    attrs = []
+    for mat in sorted(cache.AssignedMaterials(model)):
+        for attr in ['.color', '.transparency', '.specularColor', '.eccentricity']:
+            try:
+                attrs += [cache.GetAttr(mat + attr)]
+            except ValueError:
+                attrs += [None]
+        node = cache.Query(cmds.listConnections, mat, d=False, t='file')
+        if node != None:
+            attrs += [cache.GetAttr(node[0]+'.fileTextureName')]
+    return HashValues(attrs, GetShadingAssignment(cache, model))
+
+def GetBoneKey(cache, root):
+    if root == None: return HashValues(None)
+    names = cache.Query(GetHierarchyNames, root)
+    return HashValues(names, cache.Query(GetJointPositions, names[0]))
+
+def GetWeightKey(cache, model, skin_cluster, mesh_key, bone_key):
+    if skin_cluster == None: return HashValues(mesh_key, bone_key, None)
+    # the sparse weights of every vertex in one read, the influence indices
+    # of each vertex tell which joint every weight belongs to
+    weights = None
+    count = len(cache.VertexIndices(model))
+    if count > 0:
+        weights = [cache.GetAttr('%s.weightList[0:%d].weights' % (skin_cluster, count - 1))]
+        for vtx in range(count):
+            weights += [cache.Query(cmds.getAttr, '%s.weightList[%d].weights' % (skin_cluster, vtx), mi=True)]
+    influences = cache.Query(cmds.skinCluster, skin_cluster, q=True, inf=True)
+    return HashValues(mesh_key, bone_key, influences, weights)
+
+def GetSkinKey(cache, model, skins, blend_shape):
+    morphs = []
+    for name in skins:
+        morphs += [HashValues(name, cache.GetAttr(name + '.translate'), cache.VertexPositions(name))]
+    if blend_shape != None:
+        morphs += [cache.GetAttr(model + '.worldMatrix')]
+        for index, name in cache.Query(GetBlendShapeTargets, blend_shape):
+            item = GetBlendShapeTargetItem(blend_shape, index)
+            morphs += [HashValues(name, cache.GetAttr(item + '.inputComponentsTarget'), cache.GetAttr(item + '.inputPointsTarget'))]
+    return HashValues(cache.VertexPositions(model), morphs)
+
+#------------------------------------------------
+# Scene Capture
+#------------------------------------------------
+SCENE_CAPTURE_VERSION = 1
+
+def CaptureKey(prefix, name, args, kwargs):
+    return repr((prefix, name, args, sorted(kwargs.items())))
+
+# stands in for maya.cmds or maya.mel, every call goes to call(prefix, name, args, kwargs)
+class SceneModule:
+    def __init__(self, prefix, call):
+        self.prefix = prefix
+        self.call = call
+
+    def __getattr__(self, name):
+        prefix, call = self.prefix, self.call
+        def method(*args, **kwargs):
+            return call(prefix, name, args, kwargs)
+        method.__name__ = name
+        self.__dict__[name] = method
+        return method
+
+# records the arguments and results of the maya calls of an export,
+# saved as a compressed list of [key, succeeded, result or exception].
+class SceneCapture:
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+
+    def Wrap(self, module, prefix):
+        return SceneModule(prefix, lambda p, name, args, kwargs: self.Call(module, p, name, args, kwargs))
+
+    def Call(self, module, prefix, name, args, kwargs):
+        key = CaptureKey(prefix, name, args, kwargs)
+        try:
+            result = getattr(module, name)(*args, **kwargs)
+        except Exception, inst:
+            self.records.append([key, False, inst])
+            raise
+        # the exporter may change the returned lists later
+        self.records.append([key, True, copy.deepcopy(result)])
+        return result
 
-def GetPolyElementNameList(model, count, attr_name):
-    attr = []
-    for c in range(count):
-        attr.append(model + '.' + attr_name + '[' + str(c) + ']')
-    return attr
+    def Save(self):
+        f = open(self.path, 'wb')
+        try:
+            f.write(zlib.compress(cPickle.dumps((SCENE_CAPTURE_VERSION, self.records), 2)))
+        finally:
+            f.close()
+        print 'captured maya calls: ', len(self.records)
+
+# answers the maya calls from a SceneCapture file without maya, repeated
+# calls get their results in the recorded order.
+class SceneReplay:
+    def __init__(self, path):
+        self.path = path
+        self.results = self.Read()
+
+    def Read(self):
+        f = open(self.path, 'rb')
+        try:
+            version, records = cPickle.loads(zlib.decompress(f.read()))
+        finally:
+            f.close()
+        if version != SCENE_CAPTURE_VERSION:
+            raise StandardError, 'scene capture version %d is not %d.' % (version, SCENE_CAPTURE_VERSION)
+        results = {}
+        for key, ok, result in records:
+            results.setdefault(key, []).append([ok, result])
+        print 'replaying maya calls: ', len(records)
+        return results
+
+    def Wrap(self, prefix):
+        return SceneModule(prefix, self.Call)
+
+    def Call(self, prefix, name, args, kwargs):
+        key = CaptureKey(prefix, name, args, kwargs)
+        results = self.results.get(key)
+        if results == None:
+            raise StandardError, 'not in the scene capture: ' + key
+        # the last result answers any further calls
+        ok, result = results[0]
+        if len(results) > 1: results.pop(0)
+        if not ok: raise result
+        return copy.deepcopy(result)
 
 #------------------------------------------------
 # Structure Base
 #------------------------------------------------
 class BaseStructure:
-    def __init__(self, model):
+    # field -> method building it on first access, a method may set
+    # several fields at once
+    lazy = {}
+
+    def __init__(self, model, cache):
         self.model = model
+        self.cache = cache
         self.names = None
 
-    def GetUVNameList(self, pref='.uv'):
-        uv_count = cmds.polyEvaluate(self.model, uv=True)
-        uv_name_list = []
-        for i in range(uv_count):
-            uv_name_list += [self.model + pref + '[' + str(i) + ']']
-        return uv_name_list
-        
-    def GetUVMapList(self):
-        return self.GetUVNameList(pref='.map')
+    # the query cache only lives for one export
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('cache', None)
+        return state
+
+    def __getattr__(self, name):
+        if not self.lazy.has_key(name):
+            raise AttributeError, name
+        value = getattr(self, self.lazy[name])()
+        if not self.__dict__.has_key(name):
+            self.__dict__[name] = value
+        return self.__dict__[name]
+
+    # builds the fields the writers read while maya is still reachable,
+    # returns the number of fields that were built.
+    def Require(self, fields):
+        built = 0
+        for name in fields:
+            if not self.__dict__.has_key(name):
+                getattr(self, name)
+                built += 1
+        return built
+
+    def VertexName(self, index):
+        return ComponentName(self.model, 'vtx', index)
+
+    def FaceName(self, index):
+        return ComponentName(self.model, 'f', index)
+
+    def MapName(self, index):
+        return ComponentName(self.model, 'map', index)
 
 #------------------------------------------------
 # Vertex Class
 #------------------------------------------------
 class Vertex(BaseStructure):
-    def __init__(self, model):
-        BaseStructure.__init__(self, model)
+    lazy = {'uvs': 'ToUVs',
+        'map_to_vtx': 'BuildVertexIndicesFromMaps',
+        'vtx_to_map': 'BuildMapIndicesFromVertexNames',
+        'positions': 'ToPositions',
+        'normals': 'ToNormals',
+        'bone_weights': 'InitBoneWeight',
+        'bone_num': 'InitBoneNum',
+        'edge_flag': 'InitEdgeFlag'}
+
+    def __init__(self, model, cache):
+        BaseStructure.__init__(self, model, cache)
         
         print '-------------------'
         print 'importing Vertex'
         
-        self.vtx_names = GetVerticesList(model)
-        self.uv_names = self.GetUVNameList()
-        self.uv_maps = self.GetUVMapList()
-        self.uv_count = len(self.uv_names)
-        self.vertex_count = cmds.polyEvaluate(model, v=True)
+        self.vtx_indices = cache.VertexIndices(model)
+        self.uv_indices = cache.UVIndices(model)
+        self.uv_count = len(self.uv_indices)
+        self.vertex_count = len(self.vtx_indices)
         
         print 'vertex count: ', self.vertex_count
         
-        self.uvs = self.ToUVs()
-        self.map_to_vtx = self.BuildVertexIndicesFromMaps()
-        self.vtx_to_map= self.BuildMapIndicesFromVertexNames()
-        
-        #self.indices = self.ToIndices()
-        self.positions = self.ToPositions()
-        self.normals = self.ToNormals()
-        print 'normal count: ', len(self.normals)
-        
-        self.bone_weights = self.InitBoneWeight()
-        self.bone_num = self.InitBoneNum()
-        self.edge_flag = self.InitEdgeFlag()
-        
-        self.count = len(self.positions)
+        # one pmd vertex per uv
+        self.count = self.uv_count
     
+    # vtx_to_map[vertex index] -> [uv index, ...]
     def BuildMapIndicesFromVertexNames(self):
-        vtx_to_map = {}
-        for i in range(self.vertex_count):
-            vtx_to_map[self.vtx_names[i]] = cmds.polyListComponentConversion(self.vtx_names[i], tuv=True)
+        vtx_to_map = [None] * self.vertex_count
+        for i in self.vtx_indices:
+            vtx_to_map[i] = GetComponentIndices(cmds.polyListComponentConversion(self.VertexName(i), tuv=True))
         return vtx_to_map
     
+    # map_to_vtx[uv index] -> vertex index, one query per uv because the
+    # conversion of a range returns the union without the pairing
     def BuildVertexIndicesFromMaps(self):
-        map_to_vtx = {}
-        except_count = 0
-        for i in range(self.uv_count):
+        map_to_vtx = [None] * self.uv_count
+        for i in self.uv_indices:
             try:
-                to_vtx_name = cmds.polyListComponentConversion(self.uv_maps[i], tv=True)
-                map_to_vtx[self.uv_maps[i]] = to_vtx_name[0]
+                to_vtx_name = cmds.polyListComponentConversion(self.MapName(i), tv=True)
+                map_to_vtx[i] = ExpandComponentRange(to_vtx_name[0])[0]
             except:
-                print 'no exist uv: ', self.uv_maps[i]
-                map_to_vtx[self.uv_maps[i]] = map_to_vtx.values()[0]
+                print 'no exist uv: ', self.MapName(i)
+                map_to_vtx[i] = map_to_vtx[0]
         return map_to_vtx
     
     # parameter of joints is Hash<Int->String>
     def SetupBoneWeight(self, skin_cluster, joints):
         weights = [None] * self.uv_count
         bone_num = [None] * self.uv_count
-        for map,vtx in self.map_to_vtx.items():
+        for index,vtx in enumerate(self.map_to_vtx):
             joint_weights = []
             for j in range(len(joints)):
-                weight = cmds.skinPercent(skin_cluster, vtx, transform=joints[j], q=True)
+                weight = cmds.skinPercent(skin_cluster, self.VertexName(vtx), transform=joints[j], q=True)
                 joint_weights += [[j, weight]]
             
             joint_weights = sorted(joint_weights, key=lambda x:x[1], reverse=True)
             num = []
-            index = GetIndex(map)
             if len(joint_weights) > 0:
                 weights[index] = joint_weights[0][1]
                 num += [joint_weights[0][0]]
@@ -180,61 +542,59 @@ class Vertex(BaseStructure):
     def InitBoneWeight(self):
         weight = []
         for i in range(self.uv_count):
-            weight = [1]
+            weight += [1]
         return weight
     
-    def ToIndices(self):
-        indices = []
-        for name in self.vtx_names:
-            indices.append(GetIndex(name))
-        return indices
-
     def ToPositions(self):
+        model_vtx = self.cache.VertexPositions(self.model)
         pos = [None] * self.uv_count
-        for map,vtx in self.map_to_vtx.items():
-            index = GetIndex(map)
-            pos[index] = GetVertexPosition(vtx)
+        for index,vtx in enumerate(self.map_to_vtx):
+            pos[index] = model_vtx[vtx]
         return pos
             
     def ToNormals(self):
         nrm = [None] * self.uv_count
-        for map,vtx in self.map_to_vtx.items():
-            index = GetIndex(map)
-            nrm[index] = GetVertexNormal(vtx)
+        for index,vtx in enumerate(self.map_to_vtx):
+            nrm[index] = GetVertexNormal(self.VertexName(vtx))
         return nrm
 
     def ToUVs(self):
-        uvs = []
-        for name in self.uv_names:
-            uvs += [GetUVCoordinate(name)]
-        return uvs
+        if self.uv_count <= 0: return []
+        # one query for the whole range instead of one per uv
+        return self.cache.GetAttr(ComponentRangeName(self.model, 'uv', self.uv_count))
 
 #------------------------------------------------
 # Face Class
 #------------------------------------------------
+# material of every face when the materials are not exported
+DEFAULT_MATERIAL = 'default'
+
 class Face(BaseStructure):
-    def __init__(self, model, vertex):
-        BaseStructure.__init__(self, model)
+    lazy = {'vtx_indices': 'BuildSortedIndices',
+        'materials_from_face': 'ToMaterialFromFace'}
+
+    # without group_by_material the faces keep the model order and
+    # every face belongs to DEFAULT_MATERIAL
+    def __init__(self, model, cache, group_by_material=True):
+        BaseStructure.__init__(self, model, cache)
         
         print '-------------------'
         print 'importing Face'
         
-        self.names = GetFacesList(model)
-        print 'name count: ', len(self.names)
-        
-        self.vtx_indices = self.BuildTriangleIntoIndices()
-        print 'vtx indices count: ', len(self.vtx_indices)
+        self.indices = cache.FaceIndices(model)
+        print 'face count: ', len(self.indices)
         
-        self.count = len(self.vtx_indices)
+        self.group_by_material = group_by_material
+        self.count = len(self.indices)
         
-        self.materials_from_face = self.ToMaterialFromFace()
-        print 'materials from face: ', len(self.materials_from_face)
+    def BuildSortedIndices(self):
+        triangles = self.BuildTriangleIntoIndices()
+        print 'vtx indices count: ', len(triangles)
+        if not self.group_by_material: return triangles
         
-        self.vtx_indices = self.SortingFaceByMaterial(self.materials_from_face)
-        print 'sorted vtx indices count: ', len(self.vtx_indices)
-        
-        self.ResortTriangleForFaceNormal(vertex)
-        print 'resorted'
+        triangles = self.SortingFaceByMaterial(self.materials_from_face, triangles)
+        print 'sorted vtx indices count: ', len(triangles)
+        return triangles
         
     def ResortTriangleForFaceNormal(self, vertex):
         for fi in range(len(self.vtx_indices)):
@@ -258,7 +618,7 @@ class Face(BaseStructure):
                 
     
     def DotNormalAndCross(self, n, c):
-        return mm.eval('float $b = <<%f, %f, %f>> * <<%f, %f, %f>>' % (n[0], n[1], n[2], c[0], c[1], c[2]))
+        return n[0]*c[0] + n[1]*c[1] + n[2]*c[2]
     
     def NormalizeVector(self, v):
         length = 0
@@ -270,7 +630,7 @@ class Face(BaseStructure):
         return (length*v[0], length*v[1], length*v[2])
     
     def CrossVectors(self, v1, v2):
-        return mm.eval('$a = <<%f, %f, %f>> ^ <<%f, %f, %f>>' % (v1[0], v1[1], v1[2], v2[0], v2[1], v2[2]))
+        return (v1[1]*v2[2] - v1[2]*v2[1], v1[2]*v2[0] - v1[0]*v2[2], v1[0]*v2[1] - v1[1]*v2[0])
     
     def SubPosition(self, p1, p2):
         sub_p = []
@@ -278,45 +638,30 @@ class Face(BaseStructure):
             sub_p += [p1[i] - p2[i]]
         return tuple(sub_p)
         
-    def CreateIndicesFromFaceNameToUVNames(self, uv):
-        uv_indices = re.search('\[(\d+|\d+:\d+)\]', uv)
-        uv_indices = uv_indices.group().rstrip(']').lstrip('[').split(':')
-        for i, uv in enumerate(uv_indices):
-            uv_indices[i] = int(uv_indices[i])
-        if len(uv_indices) > 1:
-            diff = uv_indices[1] - uv_indices[0] - 1
-            tmp = uv_indices[1]
-            del uv_indices[1]
-            for i in range(diff):
-                uv_indices += [uv_indices[0] + i + 1]
-            uv_indices += [tmp]
-        return uv_indices
-    
-    def SearchFaceToUVForUVIndices(self, face_name):
-        face_to_uvs_name = cmds.polyListComponentConversion(face_name, tuv=True)
-        face_to_uvs = []
-        for uv in face_to_uvs_name:    # search maps
-            face_to_uvs += self.CreateIndicesFromFaceNameToUVNames(uv)
-        return face_to_uvs
+    def SearchFaceToUVForUVIndices(self, face_index):
+        face_to_uvs_name = cmds.polyListComponentConversion(self.FaceName(face_index), tuv=True)
+        return GetComponentIndices(face_to_uvs_name)
     
+    # one query per face for the same reason as the uvs of the vertices
     def BuildTriangleIntoIndices(self):
         indices = []
-        for face_name in self.names:
-            triangle = self.SearchFaceToUVForUVIndices(face_name)
+        for face_index in self.indices:
+            triangle = self.SearchFaceToUVForUVIndices(face_index)
             if len(triangle) > 3:
                 raise StandardError, "do not triangulate your model."
             indices += [triangle]
         return indices
         
     def ToMaterialFromFace(self):
+        if not self.group_by_material: return [DEFAULT_MATERIAL] * len(self.indices)
         materials = []
-        for name in self.names:
-            cmds.select(name)
+        for face_index in self.indices:
+            cmds.select(self.FaceName(face_index))
             cmds.hyperShade(smn=True)
             materials += cmds.ls(sl=True)
         return materials
     
-    def SortingFaceByMaterial(self, materials):
+    def SortingFaceByMaterial(self, materials, triangles):
         mhash = {}
         for i in range(len(materials)):
             mhash[i] = materials[i]
@@ -325,37 +670,41 @@ class Face(BaseStructure):
             sorted_mesh += [[k,v]]
         result = []
         for smesh in sorted_mesh:    # sorting mesh by material
-            result += [self.vtx_indices[smesh[0]]]
+            result += [triangles[smesh[0]]]
         return result
 
 #------------------------------------------------
 # Material Class
 #------------------------------------------------
 class Material(BaseStructure):
-    def __init__(self, model, face):
-        BaseStructure.__init__(self, model)
+    lazy = {'diffuse': 'ToDiffuse',
+        'transparent': 'ToTransparent',
+        'ambient': 'InitAmbient',
+        'specular': 'ToSpecular',
+        'specularity': 'ToSpecularity',
+        'toon_index': 'InitToonIndex',
+        'edge_flag': 'InitEdgeFlag',
+        'file_name': 'ToFileName'}
+
+    def __init__(self, model, cache, face):
+        BaseStructure.__init__(self, model, cache)
         
         print '-------------------'
         print 'importing Material'
         
-        self.materials = sorted(GetAssinedMaterialNodeFromModel(model))
-        self.diffuse = self.ToDiffuse()
-        self.transparent = self.ToTransparent()
+        self.materials = self.InitMaterials()
         self.face_count = self.CountFaceByMaterial(face)
-        self.ambient = self.InitAmbient()
-        self.specular = self.ToSpecular()
-        self.specularity = self.ToSpecularity()
-        self.toon_index = self.InitToonIndex()
-        self.edge_flag = self.InitEdgeFlag()
-        self.file_name = self.ToFileName()
         self.count = len(self.materials)
         
+    def InitMaterials(self):
+        return sorted(self.cache.AssignedMaterials(self.model))
+        
     def ToFileName(self):
         files = []
         for mat in self.materials:
-            node = cmds.listConnections(mat, d=False, t='file')
+            node = self.cache.Query(cmds.listConnections, mat, d=False, t='file')
             if node != None:
-                files += [cmds.getAttr(node[0]+'.fileTextureName')]
+                files += [self.cache.GetAttr(node[0]+'.fileTextureName')]
             else:
                 files += [u""]
         return files
@@ -376,8 +725,7 @@ class Material(BaseStructure):
         spec = []
         for mat in self.materials:
             try:
-                cmds.select(mat)
-                spec += [cmds.getAttr(mat + '.eccentricity')]
+                spec += [self.cache.GetAttr(mat + '.eccentricity')]
             except ValueError:
                 spec += [0.0]
         return spec
@@ -386,8 +734,7 @@ class Material(BaseStructure):
         spec = []
         for mat in self.materials:
             try:
-                cmds.select(mat)
-                spec += cmds.getAttr(mat + '.specularColor')
+                spec += self.cache.GetAttr(mat + '.specularColor')
             except ValueError:
                 spec += [(0.0, 0.0, 0.0)]
         return spec
@@ -401,13 +748,13 @@ class Material(BaseStructure):
     def ToDiffuse(self):
         diffuse = []
         for mat in self.materials:
-            diffuse += cmds.getAttr(mat + '.color')
+            diffuse += self.cache.GetAttr(mat + '.color')
         return diffuse
         
     def ToTransparent(self):
         transp = []
         for mat in self.materials:
-            t = cmds.getAttr(mat + '.transparency')[0]
+            t = self.cache.GetAttr(mat + '.transparency')[0]
             transp += [0.298912 * t[0] + 0.586611 * t[1] + 0.114478 * t[2]]
         return transp
     
@@ -418,25 +765,46 @@ class Material(BaseStructure):
             count += [faces.count(mat)]
         return count
 
+#------------------------------------------------
+# Default Material Class
+#------------------------------------------------
+# one plain material for the geometry only export, nothing is read from maya
+class DefaultMaterial(Material):
+    def InitMaterials(self):
+        return [DEFAULT_MATERIAL]
+        
+    def ToFileName(self):
+        return [u""]
+        
+    def ToSpecularity(self):
+        return [0.0]
+        
+    def ToSpecular(self):
+        return [(0.0, 0.0, 0.0)]
+        
+    def ToDiffuse(self):
+        return [(0.8, 0.8, 0.8)]
+        
+    def ToTransparent(self):
+        return [0.0]
+
 #------------------------------------------------
 # Bone Class
 #------------------------------------------------
 class Bone(BaseStructure):
-    def __init__(self, model, root):
-        BaseStructure.__init__(self, model)
+    lazy = {'parent': 'BuildRelative',
+        'tail_pos_index': 'InitTailPosIndex',
+        'bone_type': 'InitBoneType',
+        'ik_parent_bone_index': 'InitIKParentBone',
+        'bone_pos': 'ToBonePosition'}
+
+    def __init__(self, model, cache, root):
+        BaseStructure.__init__(self, model, cache)
         
         print '-------------------'
         print 'importing Bone'
         
-        cmds.select(root)
-        cmds.select(hierarchy=True)
-        self.names = cmds.ls(sl=True, l=True)
-        self.short = cmds.ls(sl=True)
-        self.parent = self.BuildRelative()
-        self.tail_pos_index = self.InitTailPosIndex()
-        self.bone_type = self.InitBoneType()
-        self.ik_parent_bone_index = self.InitIKParentBone()
-        self.bone_pos = self.ToBonePosition()
+        self.names, self.short = cache.Query(GetHierarchyNames, root)
         self.count = len(self.names)
         
     def InitIKParentBone(self):
@@ -446,11 +814,7 @@ class Bone(BaseStructure):
         return ik
         
     def ToBonePosition(self):
-        pos = []
-        for bone in self.names:
-            xfm = cmds.xform(bone, q=True, ws=True, t=True)
-            pos += [xfm]
-        return pos
+        return self.cache.Query(GetJointPositions, self.names)
         
     def InitBoneType(self):
         types = []
@@ -458,153 +822,768 @@ class Bone(BaseStructure):
             types = [0]
         return types
         
+    # the tail points at the first child, 0xFFFF for the end bones
     def InitTailPosIndex(self):
-        indices = []
-        for bone in self.names:
-            indices += [0xFFFF]
+        indices = [0xFFFF] * self.count
+        for i in reversed(range(self.count)):
+            if self.parent[i] != 0xFFFF:
+                indices[self.parent[i]] = i
         return indices
 
+    # the parent is the long name without its last component, the root
+    # and bones outside the hierarchy get 0xFFFF
     def BuildRelative(self):
-        rel = []
+        index = {}
         for i,bone in enumerate(self.names):
-            r = cmds.listRelatives(bone, p=True, f=True)
-            if r != None:
-                for j,p in enumerate(self.names):
-                    if r[0] == p:
-                        r = j
-                        break
-            else:
-                r = 0xFFFF
-            rel += [r]
+            index[bone] = i
+        rel = []
+        for bone in self.names:
+            rel += [index.get(bone.rsplit('|', 1)[0], 0xFFFF)]
         return rel
 
+#------------------------------------------------
+# Spatial Hash Class
+#------------------------------------------------
+MORPH_MATCH_EPSILON = 0.00001
+
+# uniform grid over a subset of positions, about one point per cell
+class SpatialHash:
+    def __init__(self, positions, indices):
+        self.positions = positions
+        self.cell = self.InitCellSize(indices)
+        self.cells = {}
+        for i in indices:
+            self.cells.setdefault(self.Key(positions[i]), []).append(i)
+        self.count = len(indices)
+        self.max_ring = self.InitMaxRing()
+        
+    def InitCellSize(self, indices):
+        if len(indices) <= 0: return 1.0
+        extent = 0.0
+        for k in range(3):
+            values = [self.positions[i][k] for i in indices]
+            extent = max(extent, max(values) - min(values))
+        cell = extent / max(1, int(round(len(indices) ** (1.0 / 3.0))))
+        return cell if cell > 0.0 else 1.0
+        
+    # rings that cover the grid from a key inside its bounds
+    def InitMaxRing(self):
+        self.low = self.high = None
+        if len(self.cells) <= 0: return 0
+        keys = self.cells.keys()
+        self.low = [min([key[k] for key in keys]) for k in range(3)]
+        self.high = [max([key[k] for key in keys]) for k in range(3)]
+        ring = 0
+        for k in range(3): ring = max(ring, self.high[k] - self.low[k])
+        return ring + 1
+        
+    # rings that cover the grid from the key, which may lie outside
+    def MaxRing(self, key):
+        if self.low == None: return 0
+        outside = 0
+        for k in range(3):
+            outside = max(outside, self.low[k] - key[k], key[k] - self.high[k])
+        return self.max_ring + outside
+        
+    def Key(self, p):
+        return (int(floor(p[0] / self.cell)), int(floor(p[1] / self.cell)), int(floor(p[2] / self.cell)))
+        
+    def Remove(self, i):
+        key = self.Key(self.positions[i])
+        self.cells[key].remove(i)
+        if len(self.cells[key]) <= 0: del self.cells[key]
+        self.count -= 1
+        
+    def RingKeys(self, key, r):
+        if r == 0: return [key]
+        keys = []
+        for x in range(-r, r+1):
+            for y in range(-r, r+1):
+                for z in range(-r, r+1):
+                    if max(abs(x), abs(y), abs(z)) == r:
+                        keys += [(key[0]+x, key[1]+y, key[2]+z)]
+        return keys
+        
+    def Distance(self, p, i):
+        q = self.positions[i]
+        return sqrt((p[0]-q[0])**2 + (p[1]-q[1])**2 + (p[2]-q[2])**2)
+        
+    # index of the nearest point within max_dist other than skip, or None
+    def Nearest(self, p, max_dist=None, skip=None):
+        key = self.Key(p)
+        best = None
+        best_dist = None
+        for r in range(self.MaxRing(key) + 1):
+            # every point of ring r is at least (r-1) cells away
+            bound = (r - 1) * self.cell
+            if best != None and best_dist <= bound: break
+            if max_dist != None and bound > max_dist: break
+            # far from the points the ring has more cells than points left
+            if 24*r*r + 2 > self.count:
+                best = self.NearestOfAll(p, skip)
+                best_dist = self.Distance(p, best) if best != None else None
+                break
+            for k in self.RingKeys(key, r):
+                for i in self.cells.get(k, []):
+                    if i == skip: continue
+                    d = self.Distance(p, i)
+                    if best == None or d < best_dist:
+                        best = i
+                        best_dist = d
+        if best != None and max_dist != None and best_dist > max_dist:
+            return None
+        return best
+        
+    def NearestOfAll(self, p, skip=None):
+        best = None
+        best_dist = None
+        for cell in self.cells.values():
+            for i in cell:
+                if i == skip: continue
+                d = self.Distance(p, i)
+                if best == None or d < best_dist:
+                    best = i
+                    best_dist = d
+        return best
+
+# pair every target vertex with a base vertex by rest position.
+# returns [base index or None for each target vertex], [unmatched target indices]
+def MatchVerticesByPosition(base, target, epsilon=MORPH_MATCH_EPSILON):
+    order = [None] * len(target)
+    grid = SpatialHash(base, [i for i, p in enumerate(base) if IsFiniteVector(p, 3)])
+    rest = []
+    unmatched = []
+    for j, p in enumerate(target):    # vertices the morph did not move
+        if not IsFiniteVector(p, 3):
+            unmatched += [j]
+            continue
+        i = grid.Nearest(p, epsilon)
+        if i == None:
+            rest += [j]
+        else:
+            order[j] = i
+            grid.Remove(i)
+    
+    # a moved vertex takes its nearest base vertex only while it is free
+    # and the vertex moved less than the distance from there to the next
+    # base vertex, any other pairing would be a guess and is reported.
+    taken = set([i for i in order if i != None])
+    grid = SpatialHash(base, [i for i, p in enumerate(base) if IsFiniteVector(p, 3)])
+    for j in rest:
+        i = grid.Nearest(target[j])
+        if i == None or i in taken:
+            unmatched += [j]
+            continue
+        k = grid.Nearest(base[i], skip=i)
+        if k != None and grid.Distance(target[j], i) >= grid.Distance(base[i], k):
+            unmatched += [j]
+            continue
+        order[j] = i
+        taken.add(i)
+    return order, sorted(unmatched)
+
+# a morph with the vertex count of the base keeps j -> j while no more of
+# its unmoved vertices sit on another base vertex than on their own.
+def KeepsVertexOrder(base, target, epsilon=MORPH_MATCH_EPSILON):
+    if len(base) != len(target): return False
+    grid = SpatialHash(base, [i for i, p in enumerate(base) if IsFiniteVector(p, 3)])
+    agree = 0
+    disagree = 0
+    for j, p in enumerate(target):
+        if not IsFiniteVector(p, 3): continue
+        if IsFiniteVector(base[j], 3) and grid.Distance(p, j) <= epsilon:
+            agree += 1
+        elif grid.Nearest(p, epsilon) != None:
+            disagree += 1
+    return disagree <= agree
+
+# None keeps the vertex order of the base, otherwise matched by position
+def GetMorphVertexOrder(base, target):
+    if KeepsVertexOrder(base, target):
+        unmatched = [j for j, p in enumerate(target) if not IsFiniteVector(p, 3)]
+        if len(unmatched) <= 0: return None, []
+        order = range(len(target))
+        for j in unmatched: order[j] = None
+        return order, unmatched
+    return MatchVerticesByPosition(base, target)
+
 #------------------------------------------------
 # Skin Class
 #------------------------------------------------
 class Skin(BaseStructure):
-    def __init__(self, model, skins):
-        BaseStructure.__init__(self, model)
+    lazy = dict.fromkeys(['skin_vertex', 'unmatched', 'morph_indices', 'morph_deltas', 'morph_offsets',
+        'vert_count', 'base_indices', 'base_positions', 'base_count'], 'BuildMorphs')
+
+    def __init__(self, model, cache, skins, blend_shape=None):
+        BaseStructure.__init__(self, model, cache)
         
         print '-------------------'
         print 'importing Skin'
         
-        self.names = skins
-        self.skin_vertex = self.SetupSkinPositions()
-        self.skin_count = len(self.skin_vertex)
-        
-        # [0] -> index, [1] -> vector
-        self.skin_indices_vertices = self.InvestigateIndicesFromVertices()        
+        # morph meshes are followed by the targets of the blendShape
+        self.skins = list(skins)
+        self.blend_shape = blend_shape
+        self.targets = self.InitBlendShapeTargets()
+        self.names = self.skins + [t[1] for t in self.targets]
+        self.skin_count = len(self.names)
+        
+    # morph i owns morph_indices[morph_offsets[i]:morph_offsets[i+1]]
+    # and the 3 floats per index of morph_deltas
+    def BuildMorphs(self):
+        self.skin_vertex = []
+        self.unmatched = {}
+        self.morph_indices = array('I')
+        self.morph_deltas = array('f')
+        self.morph_offsets = array('I', [0])
+        if self.skin_count > 0:
+            self.skin_vertex = self.SetupSkinPositions(self.skins)
+            self.InvestigateIndicesFromVertices()
+            self.ReadBlendShapeDeltas()
         self.vert_count = self.CountVertexFromSkin()
-
-        # [0] -> index, [1] -> position
-        self.base_indices_vertices = self.BuildBaseIndicesVertices()
-        self.base_count = len(self.base_indices_vertices)
-
-        self.skin_indices_vertices = self.RebuildIndicesVerticesByBase()
         
-    def RebuildIndicesVerticesByBase(self):
-        base_iv = self.base_indices_vertices
-        skin_iv = self.skin_indices_vertices
+        # base_indices[i] -> model vertex, base_positions[3*i:3*i+3] -> position
+        self.base_indices, self.base_positions = self.BuildBaseIndicesVertices()
+        self.base_count = len(self.base_indices)
+        
+        self.morph_indices = self.RebuildIndicesVerticesByBase()
         
-        for skin in skin_iv:
-            indices = []
-            for ivs in skin:
-                for bi, bv in enumerate(base_iv):
-                    if bv[0] == ivs[0]:
-                        ivs[0] = bi
-        return skin_iv
+    def AppendMorph(self, index_vec):
+        for index in sorted(index_vec.keys()):
+            self.morph_indices.append(index)
+            self.morph_deltas.extend(index_vec[index])
+        self.morph_offsets.append(len(self.morph_indices))
+        
+    def GetMorphRange(self, i):
+        return self.morph_offsets[i], self.morph_offsets[i+1]
+        
+    # morph indices point at the base records instead of the model vertices
+    def RebuildIndicesVerticesByBase(self):
+        base_index = {}
+        for bi, index in enumerate(self.base_indices):
+            base_index[index] = bi
+        return array('I', [base_index[index] for index in self.morph_indices])
         
     def GetModelVertices(self):
-        model_vtx_name = GetVerticesList(self.model)
         model_vtx = []
-        for vtx in model_vtx_name:
-            model_vtx += [list(GetVertexPosition(vtx))]
+        for pos in self.cache.VertexPositions(self.model):
+            model_vtx += [list(pos)]
         return model_vtx
         
     def BuildBaseIndicesVertices(self):
-        model_vtx = self.GetModelVertices()
-        skin_ivs = self.skin_indices_vertices
-        
-        index_flag = {}
-        for skin in skin_ivs:
-            for ivs in skin:
-                index_flag[ivs[0]] = True
+        indices = array('I', sorted(set(self.morph_indices)))
+        positions = array('f')
+        if len(indices) <= 0: return indices, positions
+        model_vtx = self.cache.VertexPositions(self.model)
+        for index in indices:
+            positions.extend(model_vtx[index])
+        return indices, positions
         
-        sorted_indices = []
-        for k,v in sorted(index_flag.items(), key=lambda x:x[0]):
-            sorted_indices += [k]
-        
-        base_ivs = []
-        for index in sorted_indices:
-            base_ivs += [[index, model_vtx[index]]]
-        return base_ivs
-        
-    # return [0] is index, [1] is vector
     def InvestigateIndicesFromVertices(self):
         model_vtx = self.GetModelVertices()
         
         skin_vtx = self.skin_vertex
-        result_vec = []
         for i in range(len(skin_vtx)):    # unit from skin
             index_vec = {}
-            sorted_vec = []
+            order = self.MatchMorphVertexOrder(i, model_vtx)
             for j in range(len(skin_vtx[i])):    # unit from vertices
+                index = j if order == None else order[j]
+                if index == None: continue
                 vec = [0, 0, 0]
-                for k in range(3): vec[k] = skin_vtx[i][j][k] - model_vtx[j][k]
+                for k in range(3): vec[k] = skin_vtx[i][j][k] - model_vtx[index][k]
             
                 move_count = 0
                 for k in range(3):
-                    if vec[k] > 0.00001:
+                    if abs(vec[k]) > 0.00001:
                         move_count += 1
                 if move_count > 0:
+                    index_vec[index] = vec
+            self.AppendMorph(index_vec)
+        
+    # morph vertex j -> base vertex order[j], None keeps the base order
+    def MatchMorphVertexOrder(self, i, model_vtx):
+        order, unmatched = GetMorphVertexOrder(model_vtx, self.skin_vertex[i])
+        if order != None:
+            print 'reordered morph: ', self.names[i]
+        if len(unmatched) > 0:
+            print 'unmatched vertices in', self.names[i], ': ', unmatched
+            self.unmatched[self.names[i]] = unmatched
+        return order
+        
+    # a target named like a selected morph mesh is that mesh, keep one
+    def InitBlendShapeTargets(self):
+        if self.blend_shape == None: return []
+        selected = set([name.split('|')[-1] for name in self.skins])
+        targets = self.cache.Query(GetBlendShapeTargets, self.blend_shape)
+        return [t for t in targets if not t[1] in selected]
+        
+    # read from the sparse target arrays, the deltas are in object space
+    # and the base positions in world space
+    def ReadBlendShapeDeltas(self):
+        if len(self.targets) <= 0: return
+        matrix = self.cache.GetAttr(self.model + '.worldMatrix')
+        for index, name in self.targets:
+            item = GetBlendShapeTargetItem(self.blend_shape, index)
+            vtx = GetComponentIndices(self.cache.GetAttr(item + '.inputComponentsTarget'))
+            points = self.cache.GetAttr(item + '.inputPointsTarget')
+            if points == None: points = []
+            
+            index_vec = {}
+            for j, p in zip(vtx, points):
+                vec = TransformDirection(matrix, p)
+                if abs(vec[0]) > 0.00001 or abs(vec[1]) > 0.00001 or abs(vec[2]) > 0.00001:
                     index_vec[j] = vec
-                
-            for k,v in sorted(index_vec.items(), key=lambda x:x[0]):
-                sorted_vec += [[k,v]]
-            result_vec += [sorted_vec]
-        return result_vec
+            self.AppendMorph(index_vec)
         
     def CountVertexFromSkin(self):
         count = []
-        for iv in self.skin_indices_vertices:
-            count += [len(iv)]
+        for i in range(self.skin_count):
+            start, end = self.GetMorphRange(i)
+            count += [end - start]
         return count
         
-    def SetupSkinPositions(self):
+    def SetupSkinPositions(self, skins):
         skin_pos = []
-        for name in self.names:
-            base_pos = cmds.getAttr(name + '.translate')
-            vtx_name_list = GetVerticesList(name)
+        for name in skins:
+            base_pos = self.cache.GetAttr(name + '.translate')
             vtx_pos = []
-            for vtx in vtx_name_list:
-                pos = list(GetVertexPosition(vtx))
+            for pos in self.cache.VertexPositions(name):
+                pos = list(pos)
                 for i in range(3): pos[i] -= float(base_pos[0][i])
                 vtx_pos += [pos]
             skin_pos += [vtx_pos]
         return skin_pos
 
+#------------------------------------------------
+# Motion Class
+#------------------------------------------------
+MOTION_POSITION_TOLERANCE = 0.01
+MOTION_ROTATION_TOLERANCE = 0.005    # radian
+MOTION_FPS = 30.0
+TIME_UNIT_FPS = {'game': 15.0, 'film': 24.0, 'pal': 25.0, 'ntsc': 30.0, 'show': 48.0, 'palf': 50.0, 'ntscf': 60.0,
+    'hour': 1.0 / 3600.0, 'min': 1.0 / 60.0, 'sec': 1.0, 'millisec': 1000.0}
+
+# the named units or the '120fps' and '23.976fps' form
+def GetTimeUnitFPS(unit):
+    if unit in TIME_UNIT_FPS: return TIME_UNIT_FPS[unit]
+    m = re.match(r'^(\d+(?:\.\d+)?)fps$', unit)
+    if m == None:
+        raise StandardError, 'unknown time unit: ' + unit
+    return float(m.group(1))
+
+# quaternions are (x, y, z, w)
+def MultiplyQuaternion(a, b):
+    return (a[3]*b[0] + a[0]*b[3] + a[1]*b[2] - a[2]*b[1],
+        a[3]*b[1] - a[0]*b[2] + a[1]*b[3] + a[2]*b[0],
+        a[3]*b[2] + a[0]*b[1] - a[1]*b[0] + a[2]*b[3],
+        a[3]*b[3] - a[0]*b[0] - a[1]*b[1] - a[2]*b[2])
+
+def InverseQuaternion(q):
+    return (-q[0], -q[1], -q[2], q[3])
+
+def RotateVector(q, v):
+    r = MultiplyQuaternion(MultiplyQuaternion(q, (v[0], v[1], v[2], 0.0)), InverseQuaternion(q))
+    return (r[0], r[1], r[2])
+
+def NormalizeQuaternion(q):
+    length = sqrt(q[0]*q[0] + q[1]*q[1] + q[2]*q[2] + q[3]*q[3])
+    if length <= 0.0: return (0.0, 0.0, 0.0, 1.0)
+    return (q[0]/length, q[1]/length, q[2]/length, q[3]/length)
+
+# rotation of a maya (row vector) 4x4 matrix given as 16 floats
+def MatrixToQuaternion(m):
+    rows = []
+    for i in range(3):
+        r = m[i*4:i*4+3]
+        length = sqrt(r[0]*r[0] + r[1]*r[1] + r[2]*r[2])
+        if length <= 0.0: length = 1.0
+        rows += [[r[0]/length, r[1]/length, r[2]/length]]
+    # column vector matrix is the transpose, a[i][j] = rows[j][i]
+    trace = rows[0][0] + rows[1][1] + rows[2][2]
+    if trace > 0.0:
+        t = sqrt(trace + 1.0) * 2.0
+        q = ((rows[1][2] - rows[2][1]) / t, (rows[2][0] - rows[0][2]) / t, (rows[0][1] - rows[1][0]) / t, 0.25 * t)
+    elif rows[0][0] > rows[1][1] and rows[0][0] > rows[2][2]:
+        t = sqrt(1.0 + rows[0][0] - rows[1][1] - rows[2][2]) * 2.0
+        q = (0.25 * t, (rows[1][0] + rows[0][1]) / t, (rows[2][0] + rows[0][2]) / t, (rows[1][2] - rows[2][1]) / t)
+    elif rows[1][1] > rows[2][2]:
+        t = sqrt(1.0 + rows[1][1] - rows[0][0] - rows[2][2]) * 2.0
+        q = ((rows[1][0] + rows[0][1]) / t, 0.25 * t, (rows[2][1] + rows[1][2]) / t, (rows[2][0] - rows[0][2]) / t)
+    else:
+        t = sqrt(1.0 + rows[2][2] - rows[0][0] - rows[1][1]) * 2.0
+        q = ((rows[2][0] + rows[0][2]) / t, (rows[2][1] + rows[1][2]) / t, 0.25 * t, (rows[0][1] - rows[1][0]) / t)
+    return NormalizeQuaternion(q)
+
+def LerpQuaternion(a, b, t):
+    return NormalizeQuaternion([a[i] + (b[i] - a[i]) * t for i in range(4)])
+
+def QuaternionAngle(a, b):
+    dot = abs(a[0]*b[0] + a[1]*b[1] + a[2]*b[2] + a[3]*b[3])
+    return 2.0 * acos(min(dot, 1.0))
+
+# douglas-peucker on [frame, position, quaternion] samples against the
+# linear interpolation mmd uses between two keyframes
+def ReduceKeyframes(samples, position_tolerance, rotation_tolerance):
+    if len(samples) <= 2: return list(samples)
+    keep = [False] * len(samples)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(samples) - 1)]
+    while len(stack) > 0:
+        first, last = stack.pop()
+        f0, p0, q0 = samples[first]
+        f1, p1, q1 = samples[last]
+        worst = None
+        worst_error = 1.0
+        for i in range(first + 1, last):
+            f, p, q = samples[i]
+            t = float(f - f0) / (f1 - f0)
+            dp = [p[k] - (p0[k] + (p1[k] - p0[k]) * t) for k in range(3)]
+            error = max(sqrt(dp[0]*dp[0] + dp[1]*dp[1] + dp[2]*dp[2]) / position_tolerance,
+                QuaternionAngle(q, LerpQuaternion(q0, q1, t)) / rotation_tolerance)
+            if error > worst_error:
+                worst = i
+                worst_error = error
+        if worst != None:
+            keep[worst] = True
+            stack += [(first, worst), (worst, last)]
+    keys = [samples[i] for i in range(len(samples)) if keep[i]]
+    # a bone that never moves needs only one key
+    if len(keys) == 2:
+        f0, p0, q0 = keys[0]
+        f1, p1, q1 = keys[1]
+        dp = [p1[k] - p0[k] for k in range(3)]
+        if sqrt(dp[0]*dp[0] + dp[1]*dp[1] + dp[2]*dp[2]) <= position_tolerance and QuaternionAngle(q0, q1) <= rotation_tolerance:
+            keys = keys[:1]
+    return keys
+
+class Motion(BaseStructure):
+    def __init__(self, model, cache, bone, start=None, end=None):
+        BaseStructure.__init__(self, model, cache)
+        
+        print '-------------------'
+        print 'importing Motion'
+        
+        self.names = bone.short
+        self.parent = bone.parent
+        self.frames = self.InitFrames(start, end)
+        print 'frame count: ', len(self.frames)
+        
+        self.rest = self.SampleMatrices(bone.names, None)
+        self.samples = self.SampleFrames(bone.names)
+        self.keyframes = []
+        self.count = 0
+        
+    # mmd frames from 0 and the maya times they are sampled at
+    def InitFrames(self, start, end):
+        fps = GetTimeUnitFPS(cmds.currentUnit(q=True, time=True))
+        if start == None: start = cmds.playbackOptions(q=True, min=True)
+        if end == None: end = cmds.playbackOptions(q=True, max=True)
+        frames = []
+        for frame in range(int(floor((end - start) * MOTION_FPS / fps)) + 1):
+            frames += [[frame, start + frame * fps / MOTION_FPS]]
+        return frames
+        
+    # the time is passed to getAttr, so the timeline is never scrubbed
+    def SampleMatrices(self, joints, time):
+        matrices = []
+        for joint in joints:
+            if time == None:
+                matrices += [cmds.getAttr(joint + '.worldMatrix')]
+            else:
+                matrices += [cmds.getAttr(joint + '.worldMatrix', time=time)]
+        return matrices
+        
+    def SampleFrames(self, joints):
+        samples = []
+        for frame, time in self.frames:
+            samples += [self.SampleMatrices(joints, time)]
+        return samples
+        
+    # world rotation change from the rest pose and world position
+    def ToWorldDelta(self, matrices):
+        delta = []
+        for i, m in enumerate(matrices):
+            rest = MatrixToQuaternion(self.rest[i])
+            delta += [[MultiplyQuaternion(MatrixToQuaternion(m), InverseQuaternion(rest)), m[12:15]]]
+        return delta
+        
+    # mmd bones are not oriented, so the local rotation is the world
+    # rotation change of the bone seen from its parent's change
+    def ToLocal(self, i, delta):
+        q, pos = delta[i]
+        rest_pos = self.rest[i][12:15]
+        parent_q = (0.0, 0.0, 0.0, 1.0)
+        parent_pos = (0.0, 0.0, 0.0)
+        parent_rest = (0.0, 0.0, 0.0)
+        p = self.parent[i]
+        if p != 0xFFFF:
+            parent_q, parent_pos = delta[p]
+            parent_rest = self.rest[p][12:15]
+        inv = InverseQuaternion(parent_q)
+        offset = RotateVector(inv, [pos[k] - parent_pos[k] for k in range(3)])
+        local_pos = [offset[k] - (rest_pos[k] - parent_rest[k]) for k in range(3)]
+        local_q = MultiplyQuaternion(inv, q)
+        # mirror z as the vertices are
+        return [local_pos[0], local_pos[1], -local_pos[2]], (-local_q[0], -local_q[1], local_q[2], local_q[3])
+        
+    # does not touch maya, safe to run on a worker thread
+    def Reduce(self, position_tolerance=MOTION_POSITION_TOLERANCE, rotation_tolerance=MOTION_ROTATION_TOLERANCE):
+        series = [[] for name in self.names]
+        for (frame, time), matrices in zip(self.frames, self.samples):
+            delta = self.ToWorldDelta(matrices)
+            for i in range(len(self.names)):
+                pos, q = self.ToLocal(i, delta)
+                if len(series[i]) > 0:    # keep the quaternions on one hemisphere
+                    last = series[i][-1][2]
+                    if last[0]*q[0] + last[1]*q[1] + last[2]*q[2] + last[3]*q[3] < 0.0:
+                        q = (-q[0], -q[1], -q[2], -q[3])
+                series[i] += [[frame, pos, q]]
+        
+        keyframes = []
+        sample_count = 0
+        for i in range(len(self.names)):
+            sample_count += len(series[i])
+            for frame, pos, q in ReduceKeyframes(series[i], position_tolerance, rotation_tolerance):
+                keyframes += [[i, frame, pos, q]]
+        self.keyframes = keyframes
+        self.count = len(keyframes)
+        print 'reduced keyframes: ', sample_count, '->', self.count
+
+#------------------------------------------------
+# Mesh Merge
+#------------------------------------------------
+def GetDeformer(cache, model, type):
+    history = cache.Query(cmds.listHistory, model)
+    for h in history:
+        if cmds.objectType(h, isType=type):
+            return h
+    return None
+
+def GetVertexOffsets(parts):
+    offsets = []
+    offset = 0
+    for part in parts:
+        offsets += [offset]
+        offset += part.vertex.count
+    return offsets
+
+def MergeVertices(parts):
+    merged = copy.copy(parts[0].vertex)
+    for name in ['positions', 'normals', 'uvs', 'bone_weights', 'bone_num', 'edge_flag']:
+        values = []
+        for part in parts: values += list(getattr(part.vertex, name))
+        setattr(merged, name, values)
+    merged.count = len(merged.positions)
+    return merged
+
+# faces of every part grouped by the unified material order
+def MergeFaces(parts, offsets):
+    faces = []
+    for part, offset in zip(parts, offsets):
+        materials = sorted(part.face.materials_from_face)
+        for triangle, mat in zip(part.face.vtx_indices, materials):
+            faces += [[mat, [i + offset for i in triangle]]]
+    faces = sorted(faces, key=lambda x:x[0])
+    merged = copy.copy(parts[0].face)
+    merged.vtx_indices = [f[1] for f in faces]
+    merged.materials_from_face = [f[0] for f in faces]
+    merged.count = len(merged.vtx_indices)
+    return merged
+
+def MergeMaterials(parts, face):
+    table = {}
+    for part in parts:
+        for i, mat in enumerate(part.material.materials):
+            if not table.has_key(mat): table[mat] = [part.material, i]
+    merged = copy.copy(parts[0].material)
+    merged.materials = sorted(table.keys())
+    # only the fields that were built, the copies cannot reach maya
+    for name in sorted(Material.lazy.keys()):
+        if not merged.__dict__.has_key(name): continue
+        values = []
+        for mat in merged.materials:
+            values += [getattr(table[mat][0], name)[table[mat][1]]]
+        setattr(merged, name, values)
+    merged.face_count = merged.CountFaceByMaterial(face)
+    merged.count = len(merged.materials)
+    return merged
+
+# morphs with the same name on several parts become one morph
+def MergeSkins(parts, offsets):
+    names = []
+    morphs = {}
+    base = {}
+    unmatched = {}
+    for part, offset in zip(parts, offsets):
+        skin = part.skin
+        unmatched.update(skin.unmatched)
+        for bi, index in enumerate(skin.base_indices):
+            base[index + offset] = skin.base_positions[bi*3:bi*3+3]
+        for i, name in enumerate(skin.names):
+            if not morphs.has_key(name):
+                names += [name]
+                morphs[name] = {}
+            start, end = skin.GetMorphRange(i)
+            for k in range(start, end):
+                index = skin.base_indices[skin.morph_indices[k]] + offset
+                morphs[name][index] = skin.morph_deltas[k*3:k*3+3]
+    
+    merged = copy.copy(parts[0].skin)
+    merged.names = names
+    merged.skin_count = len(names)
+    merged.unmatched = unmatched
+    merged.morph_indices = array('I')
+    merged.morph_deltas = array('f')
+    merged.morph_offsets = array('I', [0])
+    for name in names: merged.AppendMorph(morphs[name])
+    merged.vert_count = merged.CountVertexFromSkin()
+    merged.base_indices = array('I', sorted(base.keys()))
+    merged.base_positions = array('f')
+    for index in merged.base_indices: merged.base_positions.extend(base[index])
+    merged.base_count = len(merged.base_indices)
+    merged.morph_indices = merged.RebuildIndicesVerticesByBase()
+    return merged
+
+#------------------------------------------------
+# Mesh Part Class
+#------------------------------------------------
+class MeshPart:
+    def __init__(self, dwindow, model, skins):
+        self.model = model
+        self.skins = skins
+        self.skin_cluster = GetDeformer(dwindow.cache, model, 'skinCluster')
+        self.blend_shape = GetDeformer(dwindow.cache, model, 'blendShape')
+        self.keys = self.BuildSectionKeys(dwindow)
+        
+        cache = dwindow.cache
+        geometry_only = dwindow.geometry_only
+        self.vertex = self.LoadSection(dwindow, 'vertex', lambda: Vertex(model, cache))
+        self.face = self.LoadSection(dwindow, 'face', lambda: Face(model, cache, not geometry_only))
+        if geometry_only:
+            self.material = self.LoadSection(dwindow, 'material', lambda: DefaultMaterial(model, cache, self.face))
+            self.skin = self.LoadSection(dwindow, 'skin', lambda: Skin(model, cache, []))
+            return
+        self.material = self.LoadSection(dwindow, 'material', lambda: Material(model, cache, self.face))
+        self.skin = self.LoadSection(dwindow, 'skin', lambda: Skin(model, cache, skins, self.blend_shape))
+        
+        build = lambda: self.BuildBoneWeight(dwindow.bone)
+        self.vertex.bone_weights, self.vertex.bone_num = self.LoadSection(dwindow, 'weight', build)
+        
+    def LoadSection(self, dwindow, name, build):
+        return dwindow.LoadSection(self.Section(name, dwindow.geometry_only), self.keys.get(name), build, dwindow.fields.get(name, []))
+        
+    def Section(self, name, geometry_only=False):
+        if geometry_only: return self.model + ':geometry:' + name
+        return self.model + ':' + name
+        
+    # the geometry only export never reads materials, morphs or weights
+    def BuildSectionKeys(self, dwindow):
+        keys = {}
+        if dwindow.section_cache == None: return keys
+        cache = dwindow.cache
+        mesh = GetMeshKey(cache, self.model)
+        keys['vertex'] = mesh
+        keys['face'] = mesh
+        # the face count of every material depends on the mesh
+        keys['material'] = mesh
+        keys['skin'] = None
+        keys['weight'] = None
+        if dwindow.geometry_only: return keys
+        keys['material'] = HashValues(GetMaterialKey(cache, self.model), mesh)
+        keys['skin'] = GetSkinKey(cache, self.model, self.skins, self.blend_shape)
+        keys['weight'] = GetWeightKey(cache, self.model, self.skin_cluster, mesh, dwindow.bone_key)
+        return keys
+        
+    def BuildBoneWeight(self, bone):
+        self.vertex.SetupBoneWeight(self.skin_cluster, bone.names)
+        return (self.vertex.bone_weights, self.vertex.bone_num)
+        
+    # stages that do not touch maya
+    def Optimize(self):
+        self.face.ResortTriangleForFaceNormal(self.vertex)
+        print 'resorted: ', self.model
+
 #------------------------------------------------
 # Structure Window Class
 #------------------------------------------------
 class StructureWindow:
-    def __init__(self):
+    # geometry_only exports the mesh and bones without materials, morphs or weights
+    def __init__(self, section_cache=None, geometry_only=False):
         self.InitNames()
-        self.vertex = Vertex(self.model)
-        self.face = Face(self.model, self.vertex)
-        self.material = Material(self.model, self.face)
-        self.bone = Bone(self.model, self.root_bone)
-        self.skin = Skin(self.model, self.skin_names)
-        
-        self.skin_cluster = self.GetSkinCluster()
-        self.vertex.SetupBoneWeight(self.skin_cluster, self.bone.names)
-        
-    def GetSkinCluster(self):
-        history = cmds.listHistory(self.model)
-        for h in history:
-            if cmds.objectType(h, isType='skinCluster'):
-                return h
-        return None
-        
+        self.cache = SceneQueryCache()
+        self.section_cache = section_cache
+        self.geometry_only = geometry_only
+        self.fields = GetRequiredFields()
+        self.workspace = self.cache.Query(cmds.workspace, q=True, rd=True)
+        self.bone_key = self.BuildBoneKey()
+        self.bone = self.LoadSection('bone', self.bone_key, lambda: Bone(self.model, self.cache, self.root_bone), self.fields['bone'])
+        
+        # the morph meshes belong to the first model
+        self.parts = []
+        for i, model in enumerate(self.models):
+            skins = self.skin_names if i == 0 else []
+            self.parts += [MeshPart(self, model, skins)]
+        self.keys = self.BuildSectionKeys()
+        self.cache.Report()
+        
+    # stages that do not touch maya, safe to run on a worker thread.
+    # the merged vertex, face, material and skin exist from here on.
+    def Optimize(self):
+        for part in self.parts: part.Optimize()
+        self.MergeParts()
+        
+    def MergeParts(self):
+        if len(self.parts) == 1:
+            part = self.parts[0]
+            self.vertex, self.face, self.material, self.skin = part.vertex, part.face, part.material, part.skin
+            return
+        offsets = GetVertexOffsets(self.parts)
+        self.vertex = MergeVertices(self.parts)
+        self.face = MergeFaces(self.parts, offsets)
+        self.material = MergeMaterials(self.parts, self.face)
+        self.skin = MergeSkins(self.parts, offsets)
+        
+    def BuildBoneKey(self):
+        if self.section_cache == None: return None
+        return GetBoneKey(self.cache, self.root_bone)
+        
+    # section keys of the merged model
+    def BuildSectionKeys(self):
+        keys = {}
+        if self.section_cache == None: return keys
+        for name in ['vertex', 'face', 'material', 'skin', 'weight']:
+            keys[name] = HashValues([part.keys[name] for part in self.parts], self.geometry_only)
+        keys['bone'] = self.bone_key
+        return keys
+        
+    # reuse the stored section while its key is unchanged, otherwise build it.
+    # the fields are built here so that the worker thread never reaches maya.
+    def LoadSection(self, name, key, build, fields=[]):
+        data = None
+        if self.section_cache != None:
+            data = self.section_cache.Load(name, key)
+            if data != None:
+                print 'section cache hit: ', name
+                if isinstance(data, BaseStructure): data.cache = self.cache
+        built = data == None
+        if built: data = build()
+        if isinstance(data, BaseStructure) and data.Require(fields) > 0: built = True
+        if built and self.section_cache != None:
+            self.section_cache.Store(name, key, data)
+        return data
+        
+    # file names of the merged materials are replaced by the packaged names
+    # unresolved textures keep their own file name
+    def PackageTextures(self, package):
+        names = package.Package(self.material.file_name, self.workspace)
+        files = []
+        for f in self.material.file_name:
+            if f == None or len(f) <= 0: files += [u""]
+            else: files += [names.get(f, os.path.basename(f)[:TEXTURE_NAME_LENGTH])]
+        self.material.file_name = files
+        if len(self.keys) > 0: self.keys['texture'] = HashValues(files)
+        
+    # selected[0] is the model and selected[1] the root bone, the other
+    # skinned meshes are merged into the model and the rest are morphs.
     def InitNames(self):
         self.selected = cmds.ls(sl=True)
         print 'selected: ', self.selected
@@ -617,15 +1596,31 @@ class StructureWindow:
             self.root_bone = self.selected[1]
         except IndexError:
             self.root_bone = None
-        try:
-            self.skin_names = self.selected[2:]
-        except IndexError:
-            pass
+        self.models = [self.model]
+        self.skin_names = []
+        for name in self.selected[2:]:
+            if self.IsSkinned(name):
+                self.models += [name]
+            else:
+                self.skin_names += [name]
+                
+    def IsSkinned(self, name):
+        history = cmds.listHistory(name)
+        if history == None: return False
+        for h in history:
+            if cmds.objectType(h, isType='skinCluster'):
+                return True
+        return False
             
 #------------------------------------------------
 # Exporter Base Class
 #------------------------------------------------
 class ExporterBase:
+    # name of the structure section the written bytes depend on
+    section = None
+    # fields of the structure the writer reads
+    fields = []
+
     def __init__(self, data):
         self.data = data
         
@@ -655,7 +1650,7 @@ class ExporterBase:
             d = ord(d)
         except TypeError:
             d = d
-        bin.write(pack('<b', d))
+        bin.write(pack('<B', d & 0xFF))
         
     def Floats(self, bin, arr):
         for d in arr: self.Float(bin, d)
@@ -713,6 +1708,9 @@ class ExportHeader(ExporterBase):
 # Export Vertices Class
 #------------------------------------------------
 class ExportVertices(ExporterBase):
+    section = 'vertex'
+    fields = ['positions', 'normals', 'uvs', 'bone_num', 'bone_weights', 'edge_flag']
+
     def __init__(self, data):
         ExporterBase.__init__(self, data)
 
@@ -739,6 +1737,9 @@ class ExportVertices(ExporterBase):
 # Export Faces Class
 #------------------------------------------------
 class ExportFaces(ExporterBase):
+    section = 'face'
+    fields = ['vtx_indices']
+
     def __init__(self, data):
         ExporterBase.__init__(self, data)
 
@@ -764,6 +1765,9 @@ class ExportFaces(ExporterBase):
 # Export Materials Class
 #------------------------------------------------
 class ExportMaterials(ExporterBase):
+    section = 'material'
+    fields = ['diffuse', 'transparent', 'specularity', 'specular', 'edge_flag', 'file_name']
+
     def __init__(self, data):
         ExporterBase.__init__(self, data)
 
@@ -797,6 +1801,9 @@ class ExportMaterials(ExporterBase):
 # Export Bones Class
 #------------------------------------------------
 class ExportBones(ExporterBase):
+    section = 'bone'
+    fields = ['parent', 'tail_pos_index', 'bone_pos']
+
     def __init__(self, data):
         ExporterBase.__init__(self, data)
 
@@ -818,7 +1825,7 @@ class ExportBones(ExporterBase):
                     self.Char(bin, short_name[j])
                     
                 self.Word(bin, self.data.parent[i])
-                self.Word(bin, 0xFFFF)
+                self.Word(bin, self.data.tail_pos_index[i])
                 self.Byte(bin, 0)
                 self.Word(bin, 0)
                 
@@ -843,10 +1850,13 @@ class ExportIKs(ExporterBase):
 # Export Skins Class
 #------------------------------------------------
 class ExportSkins(ExporterBase):
+    section = 'skin'
+    fields = ['vert_count', 'base_count', 'base_indices', 'base_positions', 'morph_indices', 'morph_deltas', 'morph_offsets']
+
     def __init__(self, data):
         ExporterBase.__init__(self, data)
 
-    def WriteSkin(self, bin, word, count, type, iv):
+    def WriteSkin(self, bin, word, count, type, indices, vectors):
         print '----'
         print 'name: ', word
         print 'count: ', count
@@ -854,13 +1864,20 @@ class ExportSkins(ExporterBase):
         self.Chars(bin, word)
         self.DWord(bin, count)
         self.Byte(bin, type)
-        self.WriteVertex(bin, count, iv)
-        
-    def WriteVertex(self, bin, count, vertex):
-        for j in range(count):
-            self.DWord(bin, vertex[j][0])
-            self.Floats(bin, vertex[j][1])
-            #print 'iv: ', vertex[j][0], vertex[j][1]
+        self.WriteVertex(bin, indices, vectors)
+        
+    # interleave DWORD index and 3 floats per record into one buffer
+    def WriteVertex(self, bin, indices, vectors):
+        count = len(indices)
+        floats = array('I')
+        floats.fromstring(vectors.tostring())
+        record = array('I', [0]) * (count * 4)
+        record[0::4] = indices
+        record[1::4] = floats[0::3]
+        record[2::4] = floats[1::3]
+        record[3::4] = floats[2::3]
+        if sys.byteorder != 'little': record.byteswap()
+        bin.write(record.tostring())
 
     def Export(self, bin):
         print '-------------------'
@@ -872,19 +1889,23 @@ class ExportSkins(ExporterBase):
         
             # base
             base_name = self.ConvertStringIntoArray('base', 20)
-            self.WriteSkin(bin, base_name, self.data.base_count, 0, self.data.base_indices_vertices)
+            self.WriteSkin(bin, base_name, self.data.base_count, 0, self.data.base_indices, self.data.base_positions)
         else:
             self.Word(bin, 0)    # not have skin
         
         # skin
         for i in range(self.data.skin_count):
             skin_name = self.ConvertStringIntoArray(self.data.names[i], 20)
-            self.WriteSkin(bin, skin_name, self.data.vert_count[i], 1, self.data.skin_indices_vertices[i])
+            start, end = self.data.GetMorphRange(i)
+            self.WriteSkin(bin, skin_name, self.data.vert_count[i], 1,
+                self.data.morph_indices[start:end], self.data.morph_deltas[start*3:end*3])
 
 #------------------------------------------------
 # Export Display List for Skin Frame
 #------------------------------------------------
 class ExportSkinFrameForDisplayList(ExporterBase):
+    section = 'skin_frame'
+
     # data is Skin
     def __init__(self, data):
         ExporterBase.__init__(self, data)
@@ -904,7 +1925,18 @@ class ExportSkinFrameForDisplayList(ExporterBase):
 # Export Platform Class
 #------------------------------------------------
 class ExportPlatform:
+    # structure each writer is given
+    writers = [['vertex', ExportVertices],
+        ['face', ExportFaces],
+        ['material', ExportMaterials],
+        ['bone', ExportBones],
+        ['skin', ExportSkins],
+        ['skin', ExportSkinFrameForDisplayList]]
+
     def __init__(self, dwindow):
+        self.section_cache = dwindow.section_cache
+        self.geometry_only = dwindow.geometry_only
+        self.keys = self.BuildByteKeys(dwindow.keys)
         self.list = [ExportHeader(dwindow.model),
             ExportVertices(dwindow.vertex),
             ExportFaces(dwindow.face),
@@ -914,8 +1946,41 @@ class ExportPlatform:
             ExportSkins(dwindow.skin),
             ExportSkinFrameForDisplayList(dwindow.skin)]
 
-    def Export(self, bin):
-        for l in self.list: l.Export(bin)
+    def BuildByteKeys(self, keys):
+        if len(keys) <= 0: return {}
+        return {'vertex': HashValues(keys['vertex'], keys['weight']),
+            'face': keys['face'],
+            'material': HashValues(keys['material'], keys['face'], keys.get('texture')),
+            'bone': keys['bone'],
+            'skin': keys['skin'],
+            'skin_frame': keys['skin']}
+        
+    # the full and the geometry only bytes are kept side by side
+    def Section(self, name):
+        if self.geometry_only: return 'geometry:' + name
+        return name
+        
+    def ExportSection(self, l, bin):
+        if self.section_cache == None or l.section == None:
+            l.Export(bin)
+            return
+        name = self.Section(l.section)
+        key = self.keys[l.section]
+        data = self.section_cache.LoadBytes(name, key)
+        if data == None:
+            buf = StringIO()
+            l.Export(buf)
+            data = buf.getvalue()
+            self.section_cache.StoreBytes(name, key, data)
+        else:
+            print '-------------------'
+            print 'reusing bytes: ', l.section
+        bin.write(data)
+        
+    def Export(self, bin, progress=None):
+        for i,l in enumerate(self.list):
+            if progress != None: progress(l.__class__.__name__, i, len(self.list))
+            self.ExportSection(l, bin)
         
         print '-------------------'
         print 'exporting Window'
@@ -926,6 +1991,412 @@ class ExportPlatform:
         print '-------------------'
         print 'end'
 
+# fields built before the export, the faces keep their materials for
+# the merge and the skins their unmatched vertices for the report.
+def GetRequiredFields():
+    fields = {'vertex': [], 'face': ['materials_from_face'], 'material': [], 'bone': [], 'skin': ['unmatched']}
+    for name, writer in ExportPlatform.writers:
+        fields[name] += writer.fields
+    return fields
+
+#------------------------------------------------
+# Export Motion Header Class
+#------------------------------------------------
+class ExportMotionHeader(ExporterBase):
+    def __init__(self, model):
+        ExporterBase.__init__(self, None)
+        self.model = model
+        
+    def Export(self, bin):
+        print '-------------------'
+        print 'exporting Motion Header'
+        magic = 'Vocaloid Motion Data 0002'
+        self.Chars(bin, magic)
+        self.Chars(bin, [0] * (30 - len(magic)))
+        model_name = self.ConvertStringIntoArray(self.model, 20)
+        self.Chars(bin, model_name)
+
+#------------------------------------------------
+# Export Bone Motions Class
+#------------------------------------------------
+class ExportBoneMotions(ExporterBase):
+    # linear interpolation for x, y, z and rotation
+    interpolation = [20] * 8 + [107] * 8
+    
+    def __init__(self, data):
+        ExporterBase.__init__(self, data)
+        
+    def Export(self, bin):
+        print '-------------------'
+        print 'exporting Bone Motions'
+        print 'keyframe count: ', self.data.count
+        self.DWord(bin, self.data.count)
+        
+        names = []
+        for name in self.data.names:
+            names += [self.ConvertStringIntoArray(name, 15)]
+        interpolation = []
+        for i in range(4):
+            interpolation += self.interpolation[i:] + [0] * i
+        
+        for bone, frame, pos, q in self.data.keyframes:
+            self.Chars(bin, names[bone])
+            self.DWord(bin, frame)
+            self.Floats(bin, pos)
+            self.Floats(bin, q)
+            self.Chars(bin, interpolation)
+
+#------------------------------------------------
+# Export Empty Motions Class
+#------------------------------------------------
+class ExportEmptyMotions(ExporterBase):
+    def __init__(self):
+        ExporterBase.__init__(self, None)
+        
+    def Export(self, bin):
+        print '-------------------'
+        print 'exporting Empty Motions'
+        self.DWord(bin, 0)    # skin
+        self.DWord(bin, 0)    # camera
+        self.DWord(bin, 0)    # light
+        self.DWord(bin, 0)    # self shadow
+
+#------------------------------------------------
+# Export Motion Platform Class
+#------------------------------------------------
+class ExportMotionPlatform:
+    def __init__(self, model, motion):
+        self.list = [ExportMotionHeader(model),
+            ExportBoneMotions(motion),
+            ExportEmptyMotions()]
+        
+    def Export(self, bin, progress=None):
+        for i,l in enumerate(self.list):
+            if progress != None: progress(l.__class__.__name__, i, len(self.list))
+            l.Export(bin)
+        
+        print '-------------------'
+        print 'end'
+
+#------------------------------------------------
+# Model Validator Class
+#------------------------------------------------
+PMD_MAX_VERTICES = 0x10000    # face indices are WORD, the last is 0xFFFF
+PMD_MAX_BONES = 0xFFFF    # 0xFFFF is the parent of a root bone
+PMD_MAX_SKINS = 0xFFFE    # base is written as one more skin
+PMD_MAX_SKIN_FRAMES = 0xFF
+PMD_NAME_LENGTH = 20
+VALIDATION_SHOW_INDICES = 10
+
+# checks the whole extracted model before it is serialized and
+# reports every problem instead of stopping at the first one.
+class ModelValidator:
+    def __init__(self, dwindow):
+        self.vertex = dwindow.vertex
+        self.face = dwindow.face
+        self.material = dwindow.material
+        self.bone = dwindow.bone
+        self.skin = dwindow.skin
+        self.problems = []
+        
+    def Validate(self):
+        self.ValidateVertex()
+        self.ValidateFace()
+        self.ValidateMaterial()
+        self.ValidateBone()
+        self.ValidateSkin()
+        if len(self.problems) > 0:
+            print '-------------------'
+            print 'validation problems: ', len(self.problems)
+            for p in self.problems: print p
+        return self.problems
+        
+    def Report(self, message, indices=None):
+        if indices == None:
+            self.problems += [message]
+        elif len(indices) > 0:
+            shown = ', '.join([str(i) for i in indices[:VALIDATION_SHOW_INDICES]])
+            if len(indices) > VALIDATION_SHOW_INDICES: shown += ', ...'
+            self.problems += ['%s: %d (%s)' % (message, len(indices), shown)]
+        
+    def CheckLength(self, name, values, count):
+        if len(values) != count:
+            self.Report('%s has %d entries for %d' % (name, len(values), count))
+        
+    def ValidateVertex(self):
+        v = self.vertex
+        if v.count > PMD_MAX_VERTICES:
+            self.Report('too many vertices %d > %d' % (v.count, PMD_MAX_VERTICES))
+        for name, size in [['positions', 3], ['normals', 3], ['uvs', 2]]:
+            values = getattr(v, name)
+            self.CheckLength('vertex ' + name, values, v.count)
+            self.Report('vertex %s not finite' % name, [i for i, x in enumerate(values) if not IsFiniteVector(x, size)])
+        self.CheckLength('vertex bone_weights', v.bone_weights, v.count)
+        self.Report('vertex weights out of 0..1', [i for i, w in enumerate(v.bone_weights) if not IsFiniteNumber(w) or w < 0 or w > 1])
+        self.CheckLength('vertex bone_num', v.bone_num, v.count)
+        bone_count = self.bone.count
+        self.Report('vertex bone index out of range', [i for i, b in enumerate(v.bone_num)
+            if b == None or len(b) != 2 or min(b) < 0 or (bone_count > 0 and max(b) >= bone_count)])
+        self.CheckLength('vertex edge_flag', v.edge_flag, v.count)
+        
+    def ValidateFace(self):
+        f = self.face
+        count = self.vertex.count
+        self.CheckLength('face vtx_indices', f.vtx_indices, f.count)
+        self.Report('empty triangles', [i for i, t in enumerate(f.vtx_indices) if len(t) == 0])
+        self.Report('face index out of range', [i for i, t in enumerate(f.vtx_indices)
+            if len(t) > 0 and (len(t) != 3 or min(t) < 0 or max(t) >= count)])
+        
+    def ValidateMaterial(self):
+        m = self.material
+        for name in ['diffuse', 'transparent', 'specular', 'specularity', 'edge_flag', 'face_count', 'file_name']:
+            self.CheckLength('material ' + name, getattr(m, name), m.count)
+        self.Report('material diffuse not finite', [i for i, x in enumerate(m.diffuse) if not IsFiniteVector(x, 3)])
+        self.Report('material specular not finite', [i for i, x in enumerate(m.specular) if not IsFiniteVector(x, 3)])
+        self.Report('material transparency not finite', [i for i, x in enumerate(m.transparent) if not IsFiniteNumber(x)])
+        self.Report('material specularity not finite', [i for i, x in enumerate(m.specularity) if not IsFiniteNumber(x)])
+        self.Report('material texture name longer than %d bytes' % PMD_NAME_LENGTH,
+            [i for i, x in enumerate(m.file_name) if len(x) > PMD_NAME_LENGTH])
+        if sum(m.face_count) != self.face.count:
+            self.Report('material faces %d do not match face count %d' % (sum(m.face_count), self.face.count))
+        
+    def ValidateBone(self):
+        b = self.bone
+        if b.count >= PMD_MAX_BONES:
+            self.Report('too many bones %d >= %d' % (b.count, PMD_MAX_BONES))
+        self.CheckLength('bone parent', b.parent, b.count)
+        self.Report('bone parent out of range', [i for i, p in enumerate(b.parent) if p != 0xFFFF and (p < 0 or p >= b.count)])
+        self.Report('bone tail out of range', [i for i, t in enumerate(b.tail_pos_index) if t != 0xFFFF and (t < 0 or t >= b.count)])
+        self.Report('bone position not finite', [i for i, x in enumerate(b.bone_pos) if not IsFiniteVector(x, 3)])
+        
+    def ValidateSkin(self):
+        s = self.skin
+        if s.skin_count > PMD_MAX_SKINS:
+            self.Report('too many skins %d > %d' % (s.skin_count, PMD_MAX_SKINS))
+        if len(s.names) > PMD_MAX_SKIN_FRAMES:
+            self.Report('too many skins for the display list %d > %d' % (len(s.names), PMD_MAX_SKIN_FRAMES))
+        if len(s.morph_offsets) != s.skin_count + 1 or s.morph_offsets[-1] != len(s.morph_indices):
+            self.Report('skin offsets do not match the skin indices')
+        if len(s.morph_deltas) != len(s.morph_indices) * 3:
+            self.Report('skin deltas do not match the skin indices')
+        count = self.vertex.count
+        self.Report('skin base index out of range', [i for i, x in enumerate(s.base_indices) if x >= count])
+        self.Report('skin index out of range', [i for i, x in enumerate(s.morph_indices) if x >= s.base_count])
+        self.Report('skin base position not finite', [i // 3 for i, x in enumerate(s.base_positions) if not IsFiniteNumber(x)])
+        self.Report('skin delta not finite', [i // 3 for i, x in enumerate(s.morph_deltas) if not IsFiniteNumber(x)])
+
+#------------------------------------------------
+# Texture Package Class
+#------------------------------------------------
+TEXTURE_MANIFEST_VERSION = 1
+TEXTURE_NAME_LENGTH = 19    # leave the terminator in the 20 bytes of pmd
+TEXTURE_THREADS = 4
+
+def HashFile(path):
+    m = hashlib.md5()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(1 << 20)
+            if not data: break
+            m.update(data)
+    finally:
+        f.close()
+    return m.hexdigest()
+
+# copies the referenced textures next to the pmd under short names,
+# files with the same contents share one copy.
+class TexturePackage:
+    def __init__(self, directory, manifest_path):
+        self.directory = directory
+        self.manifest_path = manifest_path
+        self.manifest = self.ReadManifest()
+        self.missing = []
+        
+    def ReadManifest(self):
+        empty = {'sources': {}, 'names': {}, 'copied': {}}
+        if not os.path.exists(self.manifest_path):
+            return empty
+        try:
+            f = open(self.manifest_path, 'rb')
+            try:
+                version, manifest = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception, inst:
+            print 'ignore broken texture manifest: ', inst
+            return empty
+        if version != TEXTURE_MANIFEST_VERSION:
+            return empty
+        return manifest
+        
+    def SaveManifest(self):
+        f = open(self.manifest_path, 'wb')
+        try:
+            cPickle.dump((TEXTURE_MANIFEST_VERSION, self.manifest), f, 2)
+        finally:
+            f.close()
+        
+    # the hash is reused while size and mtime of the source are unchanged
+    def HashSource(self, path):
+        st = os.stat(path)
+        stored = self.manifest['sources'].get(path)
+        if stored != None and stored[0] == st.st_size and stored[1] == st.st_mtime:
+            return path, stored[2]
+        digest = HashFile(path)
+        return path, [st.st_size, st.st_mtime, digest]
+        
+    def NewName(self, path, used):
+        ext = os.path.splitext(path)[1].lower()
+        ext = ext[:TEXTURE_NAME_LENGTH - 5]
+        stems = {}
+        for name in used.keys(): stems[os.path.splitext(name)[0]] = True
+        i = 0
+        while stems.has_key('tex%02d' % i): i += 1
+        return 'tex%02d%s' % (i, ext)
+        
+    def CopyTexture(self, job):
+        source, name, digest = job
+        dest = os.path.join(self.directory, name)
+        if self.manifest['copied'].get(name) == digest and os.path.exists(dest) and os.path.getsize(dest) == os.path.getsize(source):
+            return name, digest, False
+        shutil.copyfile(source, dest)
+        return name, digest, True
+        
+    # relative names are looked up in the maya workspace, names with
+    # tokens such as <UDIM> stand for several files and are not resolved
+    def Resolve(self, f, workspace=None):
+        if '<' in f: return None
+        if os.path.isfile(f): return f
+        if workspace != None and not os.path.isabs(f):
+            path = os.path.join(workspace, f)
+            if os.path.isfile(path): return path
+        return None
+        
+    # returns {file name of the material: packaged file name}, the names
+    # that could not be resolved are left in self.missing
+    def Package(self, files, workspace=None):
+        print '-------------------'
+        print 'packaging Textures'
+        self.missing = []
+        resolved = {}
+        sources = []
+        for f in files:
+            if f == None or len(f) <= 0 or resolved.has_key(f) or f in self.missing: continue
+            path = self.Resolve(f, workspace)
+            if path == None:
+                print 'missing texture: ', f
+                self.missing += [f]
+                continue
+            resolved[f] = path
+            if not path in sources: sources += [path]
+        if len(sources) <= 0: return {}
+        
+        pool = ThreadPool(min(len(sources), TEXTURE_THREADS))
+        try:
+            digests = {}
+            for path, stored in pool.map(self.HashSource, sources):
+                if isinstance(stored, list):
+                    self.manifest['sources'][path] = stored
+                    stored = stored[2]
+                digests[path] = stored
+            
+            # stable names across exports, one per distinct content
+            used = {}
+            for digest, name in self.manifest['names'].items(): used[name] = digest
+            jobs = {}
+            names = {}
+            for path in sources:
+                digest = digests[path]
+                name = self.manifest['names'].get(digest)
+                if name == None:
+                    name = self.NewName(path, used)
+                    used[name] = digest
+                    self.manifest['names'][digest] = name
+                names[path] = name
+                if not jobs.has_key(digest): jobs[digest] = (path, name, digest)
+            
+            copied = 0
+            for name, digest, done in pool.map(self.CopyTexture, jobs.values()):
+                self.manifest['copied'][name] = digest
+                if done: copied += 1
+        finally:
+            pool.close()
+        self.SaveManifest()
+        print 'textures: ', len(sources), ' unique: ', len(jobs), ' copied: ', copied
+        packaged = {}
+        for f, path in resolved.items(): packaged[f] = names[path]
+        return packaged
+
+#------------------------------------------------
+# Background Export Class
+#------------------------------------------------
+def ReportExportProgress(name, step, count):
+    print 'export progress: %d/%d %s' % (step + 1, count, name)
+
+# serializes a finished StructureWindow snapshot without calling maya,
+# progress and completion are sent back to the main thread.
+class BackgroundExport(threading.Thread):
+    def __init__(self, dwindow, path, section_cache=None, callback=None, motion=None, motion_path=None, package=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.dwindow = dwindow
+        self.path = path
+        self.section_cache = section_cache
+        self.callback = callback
+        self.motion = motion
+        self.motion_path = motion_path
+        self.package = package
+        self.error = None
+        
+    def run(self):
+        try:
+            self.dwindow.Optimize()
+            if self.package != None:
+                self.dwindow.PackageTextures(self.package)
+            problems = ModelValidator(self.dwindow).Validate()
+            if len(problems) > 0:
+                raise StandardError, 'model validation failed with %d problems.' % len(problems)
+            e = ExportPlatform(self.dwindow)
+            bin = open(self.path, 'wb')
+            try:
+                e.Export(bin, self.Progress)
+            finally:
+                bin.close()
+            if self.section_cache != None:
+                self.section_cache.Save()
+            if self.motion != None:
+                self.ExportMotion()
+        except Exception, inst:
+            self.error = inst
+        ExecuteDeferred(self.Complete)
+        
+    def ExportMotion(self):
+        self.motion.Reduce()
+        e = ExportMotionPlatform(self.dwindow.model, self.motion)
+        bin = open(self.motion_path, 'wb')
+        try:
+            e.Export(bin, self.Progress)
+        finally:
+            bin.close()
+        
+    def Progress(self, name, step, count):
+        ExecuteDeferred(ReportExportProgress, name, step, count)
+        
+    def Complete(self):
+        if self.callback != None:
+            self.callback(self)
+        if self.error != None:
+            print type(self.error)
+            print self.error
+            raise Exception(type(self.error))
+        print 'exported: ', self.path
+        if self.motion != None:
+            print 'exported: ', self.motion_path
+        if self.package != None and len(self.package.missing) > 0:
+            print 'unresolved textures, kept by name: ', len(self.package.missing)
+            for f in self.package.missing: print '  ', f
+
 """
 cmds.select('pCube1')
 cmds.select('joint1', tgl=True)
@@ -933,18 +2404,40 @@ cmds.select('pCube2', tgl=True)
 cmds.select('pCube3', tgl=True)
 """
 
-w = StructureWindow()
+export_path = 'C:/export.pmd'
+motion_path = None    # 'C:/export.vmd' also exports the timeline
+geometry_only = False    # True skips materials, morphs and weights
+capture_path = None    # 'C:/export.capture' records the maya calls for a replay
 
+# python topmd.py <capture> <pmd> [<vmd>] replays a captured export outside maya.
+# the section cache is left out so that a capture holds every call.
+capture = replay = None
+if cmds == None:
+    replay = SceneReplay(sys.argv[1])
+    cmds, mm = replay.Wrap('cmds'), replay.Wrap('mel')
+    export_path = sys.argv[2]
+    motion_path = None
+    if len(sys.argv) > 3: motion_path = sys.argv[3]
+    section_cache = None
+elif capture_path != None:
+    capture = SceneCapture(capture_path)
+    cmds, mm = capture.Wrap(cmds, 'cmds'), capture.Wrap(mm, 'mel')
+    section_cache = None
+else:
+    section_cache = SectionCache(export_path + '.cache')
+package = TexturePackage(os.path.dirname(export_path), export_path + '.textures')
+w = StructureWindow(section_cache, geometry_only)
 
-bin = open('C:/export.pmd', 'wb')
-e = ExportPlatform(w)
-try:
-    e.Export(bin)
-except Exception, inst:
-    print type(inst)
-    print inst
-    raise Exception(type(inst))
-bin.close
+motion = None
+if motion_path != None:
+    motion = Motion(w.model, w.cache, w.bone)
+if capture != None:
+    capture.Save()
+export = BackgroundExport(w, export_path, section_cache, motion=motion, motion_path=motion_path, package=package)
+export.start()
+if replay != None:
+    export.join()
+    if export.error != None: sys.exit(1)
 
 
 #get selecting uv coordinate